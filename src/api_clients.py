@@ -1,13 +1,60 @@
+import asyncio
+import hashlib
 import logging
-from typing import Any, List, Dict
+import threading
+from collections import OrderedDict
+from typing import Any, List, Dict, Iterable, Iterator, Protocol, Tuple
 
+import httpx
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from elasticsearch import Elasticsearch, ConnectionError, TransportError
+from elasticsearch.helpers import bulk, scan
+from elasticsearch.serializer import JSONSerializer
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 from src.config import Config
+from src.embedding_store import EmbeddingStore
 
 logger = logging.getLogger(__name__)
 
+# Status codes worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class EmbeddingClient(Protocol):
+    """Anything that embeds texts synchronously: a GenAIClient or a CachedGenAIClient wrapping one."""
+
+    def generate_embeddings(self, texts: List[str], model: str, dimensions: int) -> np.ndarray | None:
+        ...
+
+
+class AsyncEmbeddingClient(Protocol):
+    """Anything that embeds texts asynchronously: an AsyncGenAIClient or a CachedGenAIClient wrapping one."""
+
+    async def generate_embeddings_async(self, texts: List[str], model: str, dimensions: int) -> np.ndarray | None:
+        ...
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    Elasticsearch JSON serializer backed by orjson.
+    Encodes NumPy arrays natively, which matters for the dense_vector payloads of bulk indexing.
+    """
+
+    def dumps(self, data: Any) -> bytes:
+        # Already-encoded bodies are forwarded as-is
+        if isinstance(data, (str, bytes)):
+            return super().dumps(data)
+        return orjson.dumps(data, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def loads(self, data: bytes) -> Any:
+        # Some responses declare JSON but have an empty body
+        return orjson.loads(data) if data else None
+
 
 class ElasticsearchClient:
     """
@@ -21,10 +68,11 @@ class ElasticsearchClient:
     def _create_client(self, host: str, api_key: str | None) -> Elasticsearch:
         """Creates and returns an Elasticsearch client instance."""
         try:
+            serializers = {JSONSerializer.mimetype: OrjsonSerializer()}
             if api_key:
-                client = Elasticsearch(host, api_key=api_key, timeout=30)
+                client = Elasticsearch(host, api_key=api_key, timeout=30, serializers=serializers)
             else:
-                client = Elasticsearch(host, timeout=30)
+                client = Elasticsearch(host, timeout=30, serializers=serializers)
 
             # Test connection
             if not client.ping():
@@ -39,56 +87,157 @@ class ElasticsearchClient:
             logger.error(f"Unexpected error initializing Elasticsearch at {host}: {e}")
             raise
 
-    def get_products(self, index_name: str, size: int = 100) -> List[Dict[str, Any]]:
-        """Collects a specific number of products from an existing Elasticsearch index."""
-        logger.info(f"Collecting {size} products from index '{index_name}'...")
+    def get_products(
+            self,
+            index_name: str,
+            batch_size: int = 500,
+            scroll: str = Config.ES_SCROLL_KEEP_ALIVE
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Streams all products from an existing Elasticsearch index.
+        Uses the scan helper (scroll API), so products are yielded lazily, batch_size at a time,
+        instead of being loaded all at once. The scroll context must survive the time the consumer
+        spends between pages, so `scroll` should exceed the slowest embed + index window.
+        Errors mid-stream are re-raised: a truncated catalog must fail the run, not end it quietly.
+        """
+        logger.info(f"Streaming products from index '{index_name}' in pages of {batch_size}...")
+        collected_count = 0
         try:
-            response = self.es.search(
-                index=index_name,
-                body={"size": size, "query": {"match_all": {}}}
-            )
-            products = [hit['_source'] for hit in response['hits']['hits']]
-            logger.info(f"Collected {len(products)} products.")
-            return products
+            for hit in scan(
+                    self.es,
+                    index=index_name,
+                    query={"query": {"match_all": {}}},
+                    size=batch_size,
+                    scroll=scroll,
+                    preserve_order=False
+            ):
+                collected_count += 1
+                yield hit['_source']
+        except TransportError as e:
+            logger.error(f"Transport error collecting products from Elasticsearch after {collected_count} products: "
+                         f"{e.info}")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error collecting products from Elasticsearch after {collected_count} products: "
+                         f"{e}")
+            raise
+        logger.info(f"Collected {collected_count} products.")
+
+    def create_index(self, index_name: str):
+        """
+        Creates the index with a quantized dense_vector mapping for the embedding field.
+        Vectors are stored as int8 (or BBQ), so KNN scans far fewer bytes per candidate.
+        """
+        mappings = {
+            "properties": {
+                Config.EMBEDDING_FIELD_NAME: {
+                    "type": "dense_vector",
+                    "dims": Config.EMBEDDING_DIMENSIONS,
+                    "index": True,
+                    "similarity": "cosine",
+                    "index_options": {
+                        "type": Config.EMBEDDING_INDEX_TYPE,
+                        "m": 16,
+                        "ef_construction": 100
+                    }
+                }
+            }
+        }
+
+        try:
+            if self.es.indices.exists(index=index_name):
+                logger.info(f"Index '{index_name}' already exists. Keeping its current mapping.")
+                self._check_vector_mapping(index_name)
+                return
+            self.es.indices.create(index=index_name, mappings=mappings)
+            logger.info(f"Created index '{index_name}' with '{Config.EMBEDDING_INDEX_TYPE}' vector mapping.")
         except TransportError as e:
-            logger.error(f"Transport error collecting products from Elasticsearch: {e.info}")
-            return []
+            logger.error(f"Transport error creating index '{index_name}': {e.info}")
+            raise
         except Exception as e:
-            logger.error(f"Unexpected error collecting products from Elasticsearch: {e}")
-            return []
+            logger.error(f"Unexpected error creating index '{index_name}': {e}")
+            raise
 
-    def index_documents(self, index_name: str, documents: List[Dict[str, Any]]):
-        """Indexes a list of documents in Elasticsearch."""
-        logger.info(f"Populating index '{index_name}' with {len(documents)} documents...")
-        indexed_count = 0
+    def _check_vector_mapping(self, index_name: str):
+        """
+        Warns if an existing index maps the embedding field differently from the configuration,
+        e.g. a dynamically mapped float dense_vector left by an earlier run, since the configured
+        quantization then never takes effect.
+        """
+        response = self.es.indices.get_mapping(index=index_name)
+        properties = next(iter(response.values()), {}).get('mappings', {}).get('properties', {})
+        field_mapping = properties.get(Config.EMBEDDING_FIELD_NAME, {})
+        index_type = field_mapping.get('index_options', {}).get('type')
+        dims = field_mapping.get('dims')
+        if index_type != Config.EMBEDDING_INDEX_TYPE or dims != Config.EMBEDDING_DIMENSIONS:
+            logger.warning(
+                f"Index '{index_name}' maps '{Config.EMBEDDING_FIELD_NAME}' with index_options.type={index_type} "
+                f"and dims={dims}, but the configuration expects '{Config.EMBEDDING_INDEX_TYPE}' "
+                f"and {Config.EMBEDDING_DIMENSIONS}. Delete the index (or reindex it into a new one) "
+                f"for the configured vector mapping to apply."
+            )
 
-        # Caution: For large volumes, consider using bulk API for more efficient indexing
+    @staticmethod
+    def _bulk_actions(index_name: str, documents: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Yields one bulk 'index' action per document, reusing the document ID if it exists."""
+        # Embeddings stay float32 arrays; OrjsonSerializer encodes them without building Python lists
         for document in documents:
-            try:
-                doc_id = str(document.get('id')) if document.get('id') else None  # Use document ID if it exists
-                self.es.index(index=index_name, id=doc_id, document=document)
-                indexed_count += 1
-            except TransportError as e:
-                logger.error(f"  Transport error indexing document {document.get('id', '')}: {e.info}")
-            except Exception as e:
-                logger.error(f"  Unexpected error indexing document {document.get('id', '')}: {e}")
-
-        logger.info(f"  Total of {indexed_count} documents indexed in '{index_name}'.")
-
-    def perform_search(self, index_name: str, body: Dict[str, Any], size: int) -> List[Dict[str, Any]]:
-        """Executes a generic search in Elasticsearch and returns the results."""
+            action = {"_index": index_name, "_source": document}
+            # An id of 0 or "" is still an id; only a missing one gets an auto-generated _id
+            if document.get('id') is not None:
+                action["_id"] = str(document.get('id'))
+            yield action
+
+    def index_documents(self, index_name: str, documents: Iterable[Dict[str, Any]], chunk_size: int = 500) -> int:
+        """
+        Indexes documents in Elasticsearch using the bulk API and returns how many were indexed.
+        Documents may be a lazy iterable; they are consumed chunk by chunk, and the bulk helper
+        keeps up to chunk_size documents buffered before each request. Per-document failures
+        are logged and counted, while errors raised by the iterable itself (or the client) are re-raised.
+        """
+        logger.info(f"Populating index '{index_name}' with documents via bulk API...")
+
         try:
-            response = self.es.search(
-                index=index_name,
-                body=body,
-                size=size
+            indexed_count, errors = bulk(
+                self.es.options(request_timeout=60),
+                self._bulk_actions(index_name, documents),
+                chunk_size=chunk_size,
+                raise_on_error=False,
+                raise_on_exception=False
             )
-            return response['hits']['hits']
         except TransportError as e:
-            logger.error(f"Transport error executing search in Elasticsearch: {e.info}")
+            logger.error(f"  Transport error during bulk indexing in '{index_name}': {e.info}")
+            raise
+        except Exception as e:
+            logger.error(f"  Unexpected error during bulk indexing in '{index_name}': {e}")
+            raise
+
+        for error in errors:
+            # Each error is a dict like {'index': {'_id': ..., 'status': ..., 'error': ...}}
+            details = next(iter(error.values()), {})
+            logger.error(f"  Error indexing document {details.get('_id', '')}: {details.get('error')}")
+
+        logger.info(f"  Total of {indexed_count} documents indexed in '{index_name}' ({len(errors)} failed).")
+        return indexed_count
+
+    def msearch(self, index_name: str, bodies: List[Dict[str, Any]], sizes: List[int]) -> List[Dict[str, Any]]:
+        """
+        Executes several searches in a single _msearch round trip.
+        Returns one response per body, in order; failed searches carry an 'error' key instead of hits.
+        """
+        searches: List[Dict[str, Any]] = []
+        for body, size in zip(bodies, sizes):
+            searches.append({"index": index_name})
+            searches.append({**body, "size": size})
+
+        try:
+            response = self.es.msearch(searches=searches)
+            return response['responses']
+        except TransportError as e:
+            logger.error(f"Transport error executing multi-search in Elasticsearch: {e.info}")
             raise
         except Exception as e:
-            logger.error(f"Unexpected error executing search in Elasticsearch: {e}")
+            logger.error(f"Unexpected error executing multi-search in Elasticsearch: {e}")
             raise
 
 
@@ -103,13 +252,75 @@ class GenAIClient:
         self.headers = {"Content-Type": "application/json"}
         if self.api_key:
             self.headers["Authorization"] = f"Bearer {self.api_key}"
+        self.session = self._create_session()
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """
+        Creates a pooled HTTP session so TCP/TLS connections are reused across calls.
+        The adapter only retries retryable status codes; connection errors and timeouts
+        are retried by _post_embeddings, so each failure is retried by exactly one layer.
+        """
+        retries = Retry(
+            total=3,
+            connect=0,
+            read=0,
+            other=0,
+            backoff_factor=0.3,
+            status_forcelist=RETRYABLE_STATUS_CODES,
+            allowed_methods=["POST"]
+        )
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retries)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        """Closes the underlying HTTP session."""
+        self.session.close()
 
-    def generate_embeddings(self, texts: List[str], model: str, dimensions: int) -> List[List[float]] | None:
-        """Generates embeddings for a list of texts in a single API call."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def generate_embeddings(self, texts: List[str], model: str, dimensions: int) -> np.ndarray | None:
+        """Generates embeddings for a list of texts in a single API call, as a float32 array of shape (n, dims)."""
         if not texts:
-            return []
+            return np.empty((0, dimensions), dtype=np.float32)
 
-        content = {
+        try:
+            payload = orjson.dumps(self._build_payload(texts, model, dimensions))
+            return self._parse_embeddings(self._post_embeddings(payload))
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request error generating embeddings: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error generating embeddings: {e}")
+        return None
+
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=1, max=10),
+        retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout)),
+        reraise=True
+    )
+    def _post_embeddings(self, payload: bytes) -> Dict[str, Any]:
+        """POSTs a pre-serialized embeddings request, retrying transient connection failures and timeouts."""
+        response = self.session.post(
+            url=self.base_url,
+            headers=self.headers,
+            data=payload,
+            timeout=Config.EMBEDDING_BATCH_SIZE * 5  # Increase timeout for larger batches
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    @staticmethod
+    def _build_payload(texts: List[str], model: str, dimensions: int) -> Dict[str, Any]:
+        """Builds the request body for an embeddings call."""
+        return {
             "instances": {
                 "texts": texts
             },
@@ -120,19 +331,201 @@ class GenAIClient:
             }
         }
 
-        try:
-            response = requests.post(
-                url=self.base_url,
-                headers=self.headers,
-                json=content,
-                timeout=Config.EMBEDDING_BATCH_SIZE * 5  # Increase timeout for larger batches
-            )
-            response.raise_for_status()
+    @staticmethod
+    def _parse_embeddings(data: Dict[str, Any]) -> np.ndarray:
+        """Extracts the embeddings of an API response as a float32 array."""
+        embeddings_data = data.get('embeddings', [])
+        return np.asarray([item['values'] for item in embeddings_data if 'values' in item], dtype=np.float32)
 
-            embeddings_data = response.json().get('embeddings', [])
-            return [item['values'] for item in embeddings_data if 'values' in item]
-        except requests.exceptions.RequestException as e:
+
+def _is_transient_httpx_error(error: BaseException) -> bool:
+    """Tells whether an httpx error is transient (transport failure or retryable status code)."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code in RETRYABLE_STATUS_CODES
+
+
+class AsyncGenAIClient(GenAIClient):
+    """
+    GenAIClient that can also generate embeddings asynchronously over HTTP/2.
+    Many batches can be in flight concurrently without one thread per request.
+    """
+
+    def __init__(self, base_url: str, api_key: str | None = None, max_connections: int = 32):
+        super().__init__(base_url, api_key)
+        self._client = httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=Config.EMBEDDING_BATCH_SIZE * 5  # Increase timeout for larger batches
+        )
+
+    async def aclose(self):
+        """Closes the underlying async HTTP client."""
+        await self._client.aclose()
+
+    async def generate_embeddings_async(self, texts: List[str], model: str, dimensions: int) -> np.ndarray | None:
+        """Async counterpart of generate_embeddings."""
+        if not texts:
+            return np.empty((0, dimensions), dtype=np.float32)
+
+        try:
+            payload = orjson.dumps(self._build_payload(texts, model, dimensions))
+            return self._parse_embeddings(await self._post_embeddings_async(payload))
+        except httpx.HTTPError as e:
             logger.error(f"Request error generating embeddings: {e}")
         except Exception as e:
             logger.error(f"Unexpected error generating embeddings: {e}")
-            return None
\ No newline at end of file
+        return None
+
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=1, max=10),
+        retry=retry_if_exception(_is_transient_httpx_error),
+        reraise=True
+    )
+    async def _post_embeddings_async(self, payload: bytes) -> Dict[str, Any]:
+        """
+        Async counterpart of _post_embeddings. httpx has no adapter-level retries, so this
+        retries both transport errors (connect, timeouts) and retryable status codes.
+        """
+        response = await self._client.post(self.base_url, content=payload)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+
+class CachedGenAIClient:
+    """
+    Wraps a GenAIClient with a two-tier cache of embeddings: an in-process LRU and,
+    optionally, a persistent EmbeddingStore that survives restarts.
+    Only texts not seen before (for the same model and dimensions) are sent to the API.
+    """
+
+    def __init__(self, client: GenAIClient, max_entries: int = 10_000, store: EmbeddingStore | None = None):
+        self.client = client
+        self.max_entries = max_entries
+        self.store = store
+        self._mem: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(text: str, model: str, dimensions: int) -> bytes:
+        return hashlib.blake2b(f"{model}\0{dimensions}\0{text}".encode("utf-8"), digest_size=32).digest()
+
+    def _lookup(self, keys: List[bytes]) -> Tuple[List[np.ndarray | None], List[int]]:
+        """
+        Returns the cached embedding (or None) for each key, plus the indices of the misses.
+        Keys missing from memory are looked up in the store; store hits are promoted into memory.
+        """
+        results: List[np.ndarray | None] = [None] * len(keys)
+        miss_indices: List[int] = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                embedding = self._mem.get(key)
+                if embedding is None:
+                    miss_indices.append(i)
+                else:
+                    self._mem.move_to_end(key)
+                    results[i] = embedding
+
+        if miss_indices and self.store is not None:
+            stored = self.store.get_many([keys[i] for i in miss_indices])
+            if stored:
+                self._remember(list(stored.keys()), list(stored.values()))
+                for i in miss_indices:
+                    results[i] = stored.get(keys[i])
+                miss_indices = [i for i in miss_indices if results[i] is None]
+        return results, miss_indices
+
+    def _remember(self, keys: List[bytes], embeddings: List[np.ndarray] | np.ndarray):
+        """Adds embeddings to the in-memory tier, evicting the least recently used ones."""
+        with self._lock:
+            for key, embedding in zip(keys, embeddings):
+                self._mem[key] = embedding
+                self._mem.move_to_end(key)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+    def _store(self, keys: List[bytes], embeddings: np.ndarray):
+        """Adds freshly generated embeddings to both tiers; the store write is a single batch."""
+        self._remember(keys, embeddings)
+        if self.store is not None:
+            self.store.put_many(list(zip(keys, embeddings)))
+
+    @staticmethod
+    def _merge(
+            results: List[np.ndarray | None],
+            miss_indices: List[int],
+            miss_embeddings: np.ndarray | None
+    ) -> np.ndarray | None:
+        """Fills the misses with the fetched embeddings, preserving input order."""
+        if miss_embeddings is None or len(miss_embeddings) != len(miss_indices):
+            return None
+        for i, embedding in zip(miss_indices, miss_embeddings):
+            results[i] = embedding
+        return np.stack(results)
+
+    def generate_embeddings(self, texts: List[str], model: str, dimensions: int) -> np.ndarray | None:
+        """Returns cached embeddings where available and fetches the rest in a single API call."""
+        if not texts:
+            return np.empty((0, dimensions), dtype=np.float32)
+
+        keys = [self._cache_key(text, model, dimensions) for text in texts]
+        results, miss_indices = self._lookup(keys)
+        if not miss_indices:
+            return np.stack(results)
+
+        miss_embeddings = self.client.generate_embeddings(
+            texts=[texts[i] for i in miss_indices],
+            model=model,
+            dimensions=dimensions
+        )
+        merged = self._merge(results, miss_indices, miss_embeddings)
+        if merged is not None:
+            self._store([keys[i] for i in miss_indices], miss_embeddings)
+        return merged
+
+    async def generate_embeddings_async(self, texts: List[str], model: str, dimensions: int) -> np.ndarray | None:
+        """Async counterpart of generate_embeddings; requires the wrapped client to be an AsyncGenAIClient."""
+        if not texts:
+            return np.empty((0, dimensions), dtype=np.float32)
+
+        keys = [self._cache_key(text, model, dimensions) for text in texts]
+        # Store reads and writes are blocking SQLite calls; keep them off the event loop
+        # so they don't stall the other in-flight batches
+        if self.store is not None:
+            results, miss_indices = await asyncio.to_thread(self._lookup, keys)
+        else:
+            results, miss_indices = self._lookup(keys)
+        if not miss_indices:
+            return np.stack(results)
+
+        miss_embeddings = await self.client.generate_embeddings_async(
+            texts=[texts[i] for i in miss_indices],
+            model=model,
+            dimensions=dimensions
+        )
+        merged = self._merge(results, miss_indices, miss_embeddings)
+        if merged is not None:
+            miss_keys = [keys[i] for i in miss_indices]
+            if self.store is not None:
+                await asyncio.to_thread(self._store, miss_keys, miss_embeddings)
+            else:
+                self._store(miss_keys, miss_embeddings)
+        return merged
+
+    async def aclose(self):
+        """Closes the wrapped client's async HTTP client."""
+        await self.client.aclose()
+
+    def close(self):
+        """Closes the wrapped client and the persistent store, if any."""
+        self.client.close()
+        if self.store is not None:
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -13,6 +13,8 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
+# httpx logs every request at INFO, which would bring back one log line per embedding batch
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
@@ -25,30 +27,47 @@ class Config:
     ES_HOST: str = os.getenv("ES_HOST", "http://localhost:9200")
     ES_API_KEY: str | None = os.getenv("ES_API_KEY")
 
+    # How long the source index scroll stays alive between pages while windows are embedded and indexed
+    ES_SCROLL_KEEP_ALIVE: str = os.getenv("ES_SCROLL_KEEP_ALIVE", "15m")
+
     OLD_ES_INDEX_NAME: str = os.getenv("OLD_ES_INDEX_NAME", "products_source")
     NEW_ES_INDEX_NAME: str = os.getenv("NEW_ES_INDEX_NAME", "products_with_embeddings")
     EMBEDDING_FIELD_NAME: str = os.getenv("EMBEDDING_FIELD_NAME", "productEmbedding")
     EMBEDDING_DIMENSIONS: int = int(os.getenv("EMBEDDING_DIMENSIONS", "512"))
+    EMBEDDING_INDEX_TYPE: str = os.getenv("EMBEDDING_INDEX_TYPE", "int8_hnsw")  # or "bbq_hnsw" on ES 8.15+
 
     # GenAI Configuration
     GENAI_URL: str = os.getenv("GENAI_URL", "http://localhost:8000/embeddings")
     GENAI_API_KEY: str | None = os.getenv("GENAI_API_KEY")
     EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "text-embedding-model-v1")
     EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "10"))
+    EMBEDDING_ASYNC_CONCURRENCY: int = int(os.getenv("EMBEDDING_ASYNC_CONCURRENCY", "8"))
+    # Products embedded per window while streaming; defaults to enough to keep every async slot busy
+    EMBEDDING_STREAM_WINDOW: int = int(
+        os.getenv("EMBEDDING_STREAM_WINDOW", str(EMBEDDING_BATCH_SIZE * EMBEDDING_ASYNC_CONCURRENCY))
+    )
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+    # SQLite file persisting embeddings across runs; set to an empty string to disable
+    EMBEDDING_CACHE_PATH: str = os.getenv("EMBEDDING_CACHE_PATH", ".emb_cache.sqlite3")
 
     # Search Configuration
     SEARCH_TERMS_FILE: str = os.getenv("SEARCH_TERMS_FILE", "terms_to_search.txt")
     SEARCH_RESULTS_LIMIT: int = int(os.getenv("SEARCH_RESULTS_LIMIT", "5"))
+    SEARCH_PARALLELISM: int = int(os.getenv("SEARCH_PARALLELISM", "4"))
+    # KNN num_candidates = max(KNN_NUM_CANDIDATES_MIN, SEARCH_RESULTS_LIMIT * KNN_NUM_CANDIDATES_FACTOR)
+    KNN_NUM_CANDIDATES_FACTOR: int = int(os.getenv("KNN_NUM_CANDIDATES_FACTOR", "4"))
+    KNN_NUM_CANDIDATES_MIN: int = int(os.getenv("KNN_NUM_CANDIDATES_MIN", "50"))
 
     @classmethod
     def validate_config(cls):
         """Validates if essential configurations are present."""
         required_vars = [
-            "ES_HOST", "GENAI_URL",
+            "ES_HOST", "GENAI_URL", "ES_SCROLL_KEEP_ALIVE",
             "OLD_ES_INDEX_NAME", "NEW_ES_INDEX_NAME",
-            "EMBEDDING_FIELD_NAME", "EMBEDDING_DIMENSIONS",
-            "EMBEDDING_MODEL", "EMBEDDING_BATCH_SIZE",
-            "SEARCH_TERMS_FILE", "SEARCH_RESULTS_LIMIT"
+            "EMBEDDING_FIELD_NAME", "EMBEDDING_DIMENSIONS", "EMBEDDING_INDEX_TYPE",
+            "EMBEDDING_MODEL", "EMBEDDING_BATCH_SIZE", "EMBEDDING_ASYNC_CONCURRENCY", "EMBEDDING_STREAM_WINDOW",
+            "SEARCH_TERMS_FILE", "SEARCH_RESULTS_LIMIT", "SEARCH_PARALLELISM",
+            "KNN_NUM_CANDIDATES_FACTOR", "KNN_NUM_CANDIDATES_MIN"
         ]
 
         missing_vars = [var for var in required_vars if not getattr(cls, var)]
@@ -1,82 +1,229 @@
+import asyncio
 import logging
-from typing import Any, List, Dict
+import random
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, List, Dict, Iterable, Iterator, Optional, Tuple
 
-from src.api_clients import GenAIClient
+import numpy as np
+
+from src.api_clients import AsyncEmbeddingClient
 from src.config import Config
 
 logger = logging.getLogger(__name__)
 
+# Upper bound of the random delay before each batch starts
+BATCH_START_JITTER_S = 0.2
 
-def add_embeddings_to_products(
-        products: List[Dict[str, Any]],
-        genai_client: GenAIClient
-) -> List[Dict[str, Any]]:
+
+async def _embed_batch_async(
+        genai_client: AsyncEmbeddingClient,
+        batch_texts: List[str],
+        semaphore: asyncio.Semaphore
+) -> np.ndarray | None:
     """
-    Adds embeddings to each product, using batch calls to the embedding API.
-    Combines 'name' and 'description' to generate the product embedding.
+    Generates embeddings for one batch; the semaphore bounds the batches in flight.
+    The random start delay spreads concurrent batches so they don't all hit the API (and a 429) at once.
+    Transient failures are already retried by the client, so a failed batch is not retried here.
     """
-    logger.info(f"Starting embedding generation for {len(products)} products in batches...")
-    processed_products = []
+    await asyncio.sleep(random.uniform(0, BATCH_START_JITTER_S))
+    async with semaphore:
+        batch_embeddings = await genai_client.generate_embeddings_async(
+            texts=batch_texts,
+            model=Config.EMBEDDING_MODEL,
+            dimensions=Config.EMBEDDING_DIMENSIONS
+        )
+    if batch_embeddings is None or len(batch_embeddings) != len(batch_texts):
+        return None
+    return batch_embeddings
+
+
+def _canonical_text(product: Dict[str, Any]) -> str:
+    """
+    Builds the text to embed for a product from its 'name' and 'description'.
+    A dict description contributes its values; any other non-string description is ignored
+    (formatting the dict directly would embed its repr, e.g. '{}').
+    """
+    description = product.get('description')
+    if not isinstance(description, str):
+        description = ' '.join(map(str, description.values())) if isinstance(description, dict) else ''
+    return f"{product.get('name', '')} {description}".strip()
 
-    # Prepare the list of texts and maintain a mapping to the original products
-    texts_to_embed = []
+
+def _prepare_texts(
+        products: List[Dict[str, Any]]
+) -> Tuple[Dict[Any, Dict[str, Any]], List[Any], Dict[str, List[int]]]:
+    """
+    Builds the text to embed for each product.
+    Returns the product ID map, the product IDs in text order, and each unique text
+    mapped to its positions in that order.
+    """
     # We use the product ID to map back, assuming 'id' is unique
     product_id_map: Dict[Any, Dict[str, Any]] = {product.get('id', idx): product for idx, product in
                                                  enumerate(products)}
 
     product_ids_ordered_for_batch: List[Any] = []
+    # Identical texts are embedded once; each maps to its positions in product_ids_ordered_for_batch
+    unique_texts: Dict[str, List[int]] = {}
 
     for product in products:
-        # Concatenate relevant fields for product embedding
-        text_to_embed = f"{product.get('name', '')} {product.get('description', {})}"
+        # Concatenate relevant fields for product embedding, once per product
+        text_to_embed = _canonical_text(product)
 
         # Ensure the text is not empty to avoid unnecessary calls or errors
-        if text_to_embed.strip():
-            texts_to_embed.append(text_to_embed)
+        if text_to_embed:
+            unique_texts.setdefault(text_to_embed, []).append(len(product_ids_ordered_for_batch))
             product_ids_ordered_for_batch.append(product.get('id', None))  # Store original ID to map back
         else:
             logger.warning(
                 f"Product with ID '{product.get('id', 'N/A')}' has no name or description. Skipping for embedding.")
 
-    # Process texts in batches
-    for i in range(0, len(texts_to_embed), Config.EMBEDDING_BATCH_SIZE):
-        batch_texts = texts_to_embed[i: i + Config.EMBEDDING_BATCH_SIZE]
-        batch_original_ids = product_ids_ordered_for_batch[i: i + Config.EMBEDDING_BATCH_SIZE]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"  {len(unique_texts)} unique texts to embed out of {len(product_ids_ordered_for_batch)}.")
+    return product_id_map, product_ids_ordered_for_batch, unique_texts
 
-        logger.info(
-            f"  Processing batch of {len(batch_texts)} texts "
-            f"({i + 1}-{min(i + Config.EMBEDDING_BATCH_SIZE, len(texts_to_embed))}/{len(texts_to_embed)})..."
-        )
 
-        batch_embeddings = genai_client.generate_embeddings(
-            texts=batch_texts,
-            model=Config.EMBEDDING_MODEL,
-            dimensions=Config.EMBEDDING_DIMENSIONS
-        )
+def _attach_embeddings(
+        product_id_map: Dict[Any, Dict[str, Any]],
+        product_ids_ordered_for_batch: List[Any],
+        unique_texts: Dict[str, List[int]],
+        unique_embeddings: np.ndarray,
+        has_embedding: np.ndarray
+) -> List[Dict[str, Any]]:
+    """Attaches the embedding of each unique text to every product sharing it, in original order."""
+    # Fan each unique embedding out to every product that shares its text.
+    # Rows stay views into unique_embeddings; they are converted to lists only when indexed.
+    final_embeddings: List[Optional[np.ndarray]] = [None] * len(product_ids_ordered_for_batch)
+    for k, positions in enumerate(unique_texts.values()):
+        if has_embedding[k]:
+            for position in positions:
+                final_embeddings[position] = unique_embeddings[k]
 
-        if batch_embeddings and len(batch_embeddings) == len(batch_texts):
-            for j, original_product_id in enumerate(batch_original_ids):
-                if original_product_id is not None and original_product_id in product_id_map:
-                    product = product_id_map[original_product_id]
-                    product[Config.EMBEDDING_FIELD_NAME] = batch_embeddings[j]
-                    processed_products.append(product)
-                else:
-                    logger.warning(
-                        f"  WARNING: Product ID {original_product_id} not found in product map. Embedding not added.")
-        else:
+    # Map embeddings back to products in their original order
+    processed_products = []
+    for original_product_id, embedding in zip(product_ids_ordered_for_batch, final_embeddings):
+        if original_product_id is None or original_product_id not in product_id_map:
             logger.warning(
-                f"    WARNING: Could not get embeddings for batch starting at {i}. "
-                f"Products in this batch might not have embeddings."
-            )
-            # If embeddings couldn't be obtained, add original products without the embedding field
-            for j, original_product_id in enumerate(batch_original_ids):
-                if original_product_id is not None and original_product_id in product_id_map:
-                    processed_products.append(product_id_map[original_product_id])
-
-    logger.info(f"Total of {len(processed_products)} products processed with embeddings.")
+                f"  WARNING: Product ID {original_product_id} not found in product map. Embedding not added.")
+            continue
+        product = product_id_map[original_product_id]
+        # If embeddings couldn't be obtained, add original products without the embedding field
+        if embedding is not None:
+            product[Config.EMBEDDING_FIELD_NAME] = embedding
+        processed_products.append(product)
+
+    return processed_products
+
+
+def _log_batch_submission(i: int, batch_size: int, total: int):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"  Submitting batch of {batch_size} texts ({i + 1}-{min(i + batch_size, total)}/{total})...")
+
+
+def _log_batch_failure(i: int):
+    logger.warning(
+        f"    WARNING: Could not get embeddings for batch starting at {i}. "
+        f"Products in this batch might not have embeddings."
+    )
+
+
+async def add_embeddings_to_products_async(
+        products: List[Dict[str, Any]],
+        genai_client: AsyncEmbeddingClient
+) -> List[Dict[str, Any]]:
+    """
+    Adds embeddings to each product, using batch calls to the embedding API.
+    Combines 'name' and 'description' to generate the product embedding. All batches are
+    awaited together with asyncio.gather, bounded by EMBEDDING_ASYNC_CONCURRENCY.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Starting async embedding generation for {len(products)} products in batches...")
+    product_id_map, product_ids_ordered_for_batch, unique_texts = _prepare_texts(products)
+
+    texts_to_send = list(unique_texts.keys())
+    unique_embeddings = np.zeros((len(texts_to_send), Config.EMBEDDING_DIMENSIONS), dtype=np.float32)
+    has_embedding = np.zeros(len(texts_to_send), dtype=bool)
+
+    semaphore = asyncio.Semaphore(Config.EMBEDDING_ASYNC_CONCURRENCY)
+    batch_starts = list(range(0, len(texts_to_send), Config.EMBEDDING_BATCH_SIZE))
+    coroutines = []
+    for i in batch_starts:
+        batch_texts = texts_to_send[i: i + Config.EMBEDDING_BATCH_SIZE]
+        _log_batch_submission(i, len(batch_texts), len(texts_to_send))
+        coroutines.append(_embed_batch_async(genai_client, batch_texts, semaphore))
+
+    # gather preserves the submission order, so results line up with batch_starts
+    for i, batch_embeddings in zip(batch_starts, await asyncio.gather(*coroutines)):
+        if batch_embeddings is None:
+            _log_batch_failure(i)
+            continue
+        unique_embeddings[i: i + len(batch_embeddings)] = batch_embeddings
+        has_embedding[i: i + len(batch_embeddings)] = True
+
+    processed_products = _attach_embeddings(product_id_map, product_ids_ordered_for_batch, unique_texts,
+                                            unique_embeddings, has_embedding)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Total of {len(processed_products)} products processed with embeddings.")
     return processed_products
 
 
+@contextmanager
+def background_event_loop() -> Iterator[asyncio.AbstractEventLoop]:
+    """
+    Runs a fresh event loop in a daemon thread for the duration of the block, so coroutines
+    can be scheduled on it (asyncio.run_coroutine_threadsafe) while the caller keeps working.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="embedding-loop", daemon=True)
+    thread.start()
+    try:
+        yield loop
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def iter_products_with_embeddings(
+        products: Iterable[Dict[str, Any]],
+        genai_client: AsyncEmbeddingClient,
+        loop: asyncio.AbstractEventLoop
+) -> Iterator[Dict[str, Any]]:
+    """
+    Embeds products window by window as they stream in and yields them ready for bulk indexing,
+    so memory stays proportional to EMBEDDING_STREAM_WINDOW rather than to the catalog size.
+    Windows run on `loop`, which must be running in another thread (see background_event_loop):
+    window N+1 is submitted before window N is yielded, so it is read and embedded while the
+    consumer indexes window N. This only holds if the consumer flushes once per window (bulk
+    chunk_size equal to EMBEDDING_STREAM_WINDOW); a larger chunk buffers several windows and
+    overlaps only at its flushes.
+    """
+    logger.info(f"Starting streamed embedding generation in windows of {Config.EMBEDDING_STREAM_WINDOW} products...")
+    processed_count = 0
+    products_iter = iter(products)
+
+    def submit_next_window() -> Optional[Future]:
+        window = list(islice(products_iter, Config.EMBEDDING_STREAM_WINDOW))
+        if not window:
+            return None
+        return asyncio.run_coroutine_threadsafe(add_embeddings_to_products_async(window, genai_client), loop)
+
+    pending = submit_next_window()
+    try:
+        while pending is not None:
+            processed_products = pending.result()
+            pending = submit_next_window()
+            processed_count += len(processed_products)
+            yield from processed_products
+    finally:
+        # Don't leave a window embedding in the background if the consumer stopped early or failed
+        if pending is not None:
+            pending.cancel()
+    logger.info(f"Total of {processed_count} products processed with embeddings.")
+
+
 def read_search_terms_from_file(file_path: str) -> List[str]:
     """Reads search terms from a text file."""
     logger.info(f"Reading search terms from '{file_path}'...")
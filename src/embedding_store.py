@@ -0,0 +1,56 @@
+import logging
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """
+    Persistent key -> embedding store backed by a single SQLite table.
+    Vectors are stored as float16 blobs (half the disk size of float32) and
+    returned as float32 arrays, so a rerun over the same catalog needs no API calls.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # The connection is used from asyncio.to_thread workers and the main thread; the lock serializes access
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS emb (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+        logger.info(f"Opened embedding store at '{path}'.")
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Returns the stored embeddings for the given keys; missing keys are absent from the result."""
+        found: Dict[bytes, np.ndarray] = {}
+        if not keys:
+            return found
+        # Stay well below SQLite's limit on bound parameters per statement
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i: i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM emb WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float16).astype(np.float32)
+        return found
+
+    def put_many(self, items: List[Tuple[bytes, np.ndarray]]):
+        """Stores embeddings in a single transaction, replacing existing keys."""
+        if not items:
+            return
+        rows = [(key, np.asarray(embedding, dtype=np.float16).tobytes()) for key, embedding in items]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO emb (key, vec) VALUES (?, ?)", rows)
+
+    def close(self):
+        """Closes the SQLite connection."""
+        with self._lock:
+            self._conn.close()
@@ -1,15 +1,52 @@
-import time
+import asyncio
+import atexit
 import logging
 import pandas as pd
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
 
 from src.config import Config
-from src.api_clients import ElasticsearchClient, GenAIClient
-from src.data_processing import add_embeddings_to_products, read_search_terms_from_file
-from src.search_engine import SearchService
+from src.api_clients import ElasticsearchClient, AsyncGenAIClient, CachedGenAIClient
+from src.embedding_store import EmbeddingStore
+from src.data_processing import background_event_loop, iter_products_with_embeddings, read_search_terms_from_file
+from src.search_engine import SearchService, RESULT_COLUMNS
 
 logger = logging.getLogger(__name__)
 
+RESULTS_DIR = "results"
+
+
+def process_term(
+        search_service: SearchService,
+        term: str,
+        embedding: List[float] | None
+) -> Tuple[List[Dict[str, Any]], Dict[str, List[Any]]]:
+    """
+    Runs the Semantic, Hybrid and Lexical searches for one term.
+    Returns the term's summary rows and its long-form result columns.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"\nPerforming searches for term: '{term}'")
+
+    # Semantic, Hybrid and Lexical searches in a single round trip
+    search_results = search_service.run_all_searches(term, Config.NEW_ES_INDEX_NAME, embedding=embedding)
+
+    summary_rows = []
+    result_columns: Dict[str, List[Any]] = {column: [] for column in RESULT_COLUMNS}
+    for search_type, (hits, execution_time, status) in search_results.items():
+        summary_rows.append({
+            'searched_term': term,
+            'search_type': search_type,
+            'status': status,
+            'execution_time_s': execution_time,
+            'result_product_names': [SearchService.hit_field(hit, 'name') for hit in hits]
+        })
+        SearchService.append_hits(result_columns, term, search_type, hits)
+
+    return summary_rows, result_columns
+
+
 def main():
     """
     Main function to orchestrate the vector search testing process.
@@ -19,27 +56,42 @@ def main():
     try:
         # Initialize Clients
         es_client = ElasticsearchClient(Config.ES_HOST, Config.ES_API_KEY)
-        genai_client = GenAIClient(
-            base_url=Config.GENAI_URL,
-            api_key=Config.GENAI_API_KEY
+        genai_client = CachedGenAIClient(
+            AsyncGenAIClient(
+                base_url=Config.GENAI_URL,
+                api_key=Config.GENAI_API_KEY
+            ),
+            max_entries=Config.EMBEDDING_CACHE_SIZE,
+            store=EmbeddingStore(Config.EMBEDDING_CACHE_PATH) if Config.EMBEDDING_CACHE_PATH else None
         )
+        atexit.register(genai_client.close)
         search_service = SearchService(es_client, genai_client)
 
-        # 1. Collect products from Elasticsearch
-        products_to_process = es_client.get_products(Config.OLD_ES_INDEX_NAME, size=500)
-        if not products_to_process:
-            logger.warning("No products collected. Exiting.")
+        # 1-3. Stream products from the source index, embed them window by window and
+        # bulk-index them into the new index as they are produced
+        es_client.create_index(Config.NEW_ES_INDEX_NAME)
+        # Embedding runs on a background loop so the next window is embedded while this one is indexed;
+        # a failure while streaming the source index propagates and aborts the run
+        with background_event_loop() as loop:
+            try:
+                products_with_embeddings = iter_products_with_embeddings(
+                    es_client.get_products(Config.OLD_ES_INDEX_NAME, batch_size=500),
+                    genai_client,
+                    loop
+                )
+                # One bulk request per window, so window N+1 embeds while window N is sent
+                indexed_count = es_client.index_documents(
+                    Config.NEW_ES_INDEX_NAME,
+                    products_with_embeddings,
+                    chunk_size=Config.EMBEDDING_STREAM_WINDOW
+                )
+            finally:
+                # Close the async HTTP client on the loop its connections belong to
+                asyncio.run_coroutine_threadsafe(genai_client.aclose(), loop).result()
+        if not indexed_count:
+            logger.warning("No products indexed with embeddings. Exiting.")
             return
 
-        # 2. Generate embeddings for the products
-        products_with_embeddings = add_embeddings_to_products(products_to_process, genai_client)
-        if not products_with_embeddings:
-            logger.warning("No embeddings generated. Exiting.")
-            return
-
-        # 3. Index products with embeddings
-        es_client.index_documents(Config.NEW_ES_INDEX_NAME, products_with_embeddings)
-
         # 4. Read search terms from a file
         search_terms_file_path = os.path.join(os.path.dirname(__file__), '..', Config.SEARCH_TERMS_FILE)
         search_terms = read_search_terms_from_file(search_terms_file_path)
@@ -47,76 +99,39 @@ def main():
             logger.warning("No search terms read. Exiting.")
             return
 
-        # 5. Perform searches and log results
-        all_results = []
-        for term in search_terms:
-            logger.info(f"\nPerforming searches for term: '{term}'")
-
-            # Semantic Search
-            start_time_sem = time.time()
-            df_semantic = search_service.run_semantic_search(term, Config.NEW_ES_INDEX_NAME)
-            end_time_sem = time.time()
-            time_sem = end_time_sem - start_time_sem
-
-            result_sem = {
-                'searched_term': term,
-                'search_type': 'Semantic',
-                'execution_time_s': time_sem,
-                'result_product_names': df_semantic['Product Name'].tolist() if not df_semantic.empty else []
-            }
-            all_results.append(result_sem)
-
-            csv_filename_sem = f"results/{term.replace(' ', '_')}_semantic.csv"
-            os.makedirs(os.path.dirname(csv_filename_sem), exist_ok=True)
-            df_semantic.to_csv(csv_filename_sem, index=False)
-            logger.info(f"  Semantic results for '{term}' saved to '{csv_filename_sem}'.")
-
-            # Hybrid Search
-            start_time_hyb = time.time()
-            df_hybrid = search_service.run_hybrid_search(term, Config.NEW_ES_INDEX_NAME)
-            end_time_hyb = time.time()
-            time_hyb = end_time_hyb - start_time_hyb
-
-            result_hyb = {
-                'searched_term': term,
-                'search_type': 'Hybrid',
-                'execution_time_s': time_hyb,
-                'result_product_names': df_hybrid['Product Name'].tolist() if not df_hybrid.empty else []
-            }
-            all_results.append(result_hyb)
-
-            csv_filename_hyb = f"results/{term.replace(' ', '_')}_hybrid.csv"
-            os.makedirs(os.path.dirname(csv_filename_hyb), exist_ok=True)
-            df_hybrid.to_csv(csv_filename_hyb, index=False)
-            logger.info(f"  Hybrid results for '{term}' saved to '{csv_filename_hyb}'.")
-
-            # Lexical Search
-            start_time_lex = time.time()
-            df_lexical = search_service.run_lexical_search(term, Config.NEW_ES_INDEX_NAME)
-            end_time_lex = time.time()
-            time_lex = end_time_lex - start_time_lex
-
-            result_lex = {
-                'searched_term': term,
-                'search_type': 'Lexical',
-                'execution_time_s': time_lex,
-                'result_product_names': df_lexical['Product Name'].tolist() if not df_lexical.empty else []
-            }
-            all_results.append(result_lex)
-
-            csv_filename_lex = f"results/{term.replace(' ', '_')}_lexical.csv"
-            os.makedirs(os.path.dirname(csv_filename_lex), exist_ok=True)
-            df_lexical.to_csv(csv_filename_lex, index=False)
-            logger.info(f"  Lexical results for '{term}' saved to '{csv_filename_lex}'.")
-
-            logger.info("-" * 50)
+        # 5. Embed all search terms in batches, then perform searches and log results
+        query_embeddings = search_service.precompute_query_embeddings(search_terms)
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        summary_rows = []
+        result_columns: Dict[str, List[Any]] = {column: [] for column in RESULT_COLUMNS}
+
+        def run_term(term: str) -> Tuple[List[Dict[str, Any]], Dict[str, List[Any]]]:
+            return process_term(search_service, term, query_embeddings.get(term))
+
+        # Terms are independent, so several run concurrently; map keeps the results in term order
+        with ThreadPoolExecutor(max_workers=Config.SEARCH_PARALLELISM) as executor:
+            for term_summary_rows, term_columns in executor.map(run_term, search_terms):
+                summary_rows.extend(term_summary_rows)
+                for column in RESULT_COLUMNS:
+                    result_columns[column].extend(term_columns[column])
+
+        search_service.clear_query_embedding_cache()
+        logger.info(f"Performed {len(summary_rows)} searches for {len(search_terms)} terms "
+                    f"({len(result_columns['term'])} results).")
+
+        # Save all results as a single long-form table
+        df_results = pd.DataFrame(result_columns, columns=RESULT_COLUMNS)
+        results_parquet_filename = os.path.join(RESULTS_DIR, "all.parquet")
+        df_results.to_parquet(results_parquet_filename, compression="zstd", index=False)
+        results_csv_filename = os.path.join(RESULTS_DIR, "all_results.csv")
+        df_results.to_csv(results_csv_filename, index=False)
+        logger.info(f"\nAll search results saved to '{results_parquet_filename}' and '{results_csv_filename}'.")
 
         # Save a summary of all results
-        df_all_results = pd.DataFrame(all_results)
-        summary_csv_filename = "results/summary_vector_search_tests.csv"
-        os.makedirs(os.path.dirname(summary_csv_filename), exist_ok=True)
-        df_all_results.to_csv(summary_csv_filename, index=False)
-        logger.info(f"\nOverall test summary saved to '{summary_csv_filename}'.")
+        df_summary = pd.DataFrame(summary_rows)
+        summary_csv_filename = os.path.join(RESULTS_DIR, "summary_vector_search_tests.csv")
+        df_summary.to_csv(summary_csv_filename, index=False)
+        logger.info(f"Overall test summary saved to '{summary_csv_filename}'.")
         logger.info("Vector search testing process completed successfully!")
 
     except ValueError as ve:
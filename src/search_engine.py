@@ -1,156 +1,213 @@
+import copy
 import logging
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
-import pandas as pd
 from elasticsearch import TransportError
 
-from src.api_clients import ElasticsearchClient, GenAIClient
+from src.api_clients import ElasticsearchClient, EmbeddingClient
 from src.config import Config
 
 logger = logging.getLogger(__name__)
 
+# Columns of the long-form results table (one row per returned hit)
+RESULT_COLUMNS = ['term', 'search_type', 'rank', 'product_id', 'product_name', 'product_url', 'score']
+
+# Per-search status reported in the summary
+SEARCH_STATUS_OK = "ok"
+SEARCH_STATUS_SKIPPED = "skipped"
+SEARCH_STATUS_ERROR = "error"
+
 
 class SearchService:
     """
     Encapsulates the logic for semantic, hybrid, and lexical search in Elasticsearch.
     """
 
-    def __init__(self, es_client: ElasticsearchClient, genai_client: GenAIClient):
+    def __init__(self, es_client: ElasticsearchClient, genai_client: EmbeddingClient):
         self.es_client = es_client
         self.genai_client = genai_client
+        # Query embeddings memoized per term for the current run, shared by all search modes
+        self._query_embedding_cache: Dict[str, List[float]] = {}
+
+        # Query body skeletons built once; each search only fills in the term or the query vector.
+        # Per-call bodies are shallow copies, so the templates themselves are never mutated.
+        # Result fields are fetched via the fields API with _source disabled, so the
+        # (large) embedding field is never loaded or serialized per hit
+        self._result_fields = [{"field": "name"}, {"field": "id"}, {"field": "productUrl"}]
+        self._multi_match_template = {
+            "query": None,
+            "fields": [
+                "name^10.0",
+                "description^5.0"
+            ],
+            "boost": 2.5
+        }
+        self._lex_body_template = {
+            "query": {"multi_match": self._multi_match_template},
+            "fields": self._result_fields,
+            "_source": False
+        }
+        self._knn_body_template = {
+            "knn": {
+                "field": Config.EMBEDDING_FIELD_NAME,
+                "query_vector": None,
+                "k": Config.SEARCH_RESULTS_LIMIT,
+                "num_candidates": max(
+                    Config.KNN_NUM_CANDIDATES_MIN,
+                    Config.SEARCH_RESULTS_LIMIT * Config.KNN_NUM_CANDIDATES_FACTOR
+                )
+            },
+            "fields": self._result_fields,
+            "_source": False
+        }
+        self._hybrid_knn_template = {**self._knn_body_template["knn"], "boost": 2.0}
+
+    def clear_query_embedding_cache(self):
+        """Forgets the query embeddings memoized during this run."""
+        self._query_embedding_cache.clear()
 
     def _generate_query_embedding(self, term: str) -> List[float] | None:
-        """Generates the embedding for a search term."""
+        """Generates the embedding for a search term, reusing it if this term was already embedded."""
+        cached_embedding = self._query_embedding_cache.get(term)
+        if cached_embedding is not None:
+            return cached_embedding
+
         query_embeddings = self.genai_client.generate_embeddings(
             texts=[term],
             model=Config.EMBEDDING_MODEL,
             dimensions=Config.EMBEDDING_DIMENSIONS
         )
-        if not query_embeddings[0]:
+        if query_embeddings is None or len(query_embeddings) == 0 or len(query_embeddings[0]) == 0:
             logger.warning(f"Could not generate embedding for term '{term}'.")
             return None
-        return query_embeddings[0]
-
-    def run_semantic_search(self, term: str, index_name: str) -> pd.DataFrame:
-        """Executes a pure vector (KNN) search in Elasticsearch."""
-        logger.info(f"  Executing Semantic search for '{term}' on index '{index_name}'...")
-
-        query_embedding = self._generate_query_embedding(term)
-        if query_embedding is None:
-            return pd.DataFrame()
-
-        body = {
-            "knn": {
-                "field": Config.EMBEDDING_FIELD_NAME,
-                "query_vector": query_embedding,
-                "k": Config.SEARCH_RESULTS_LIMIT,
-                "num_candidates": Config.SEARCH_RESULTS_LIMIT * 10
-            },
-            "_source": ["name", "id", "productUrl"]  # Including more relevant fields
+        query_embedding = query_embeddings[0].tolist()
+        self._query_embedding_cache[term] = query_embedding
+        return query_embedding
+
+    def precompute_query_embeddings(self, terms: List[str]) -> Dict[str, List[float]]:
+        """Generates embeddings for all search terms up front, in batches of EMBEDDING_BATCH_SIZE."""
+        query_embeddings: Dict[str, List[float]] = {
+            term: self._query_embedding_cache[term] for term in terms if term in self._query_embedding_cache
         }
-
-        try:
-            hits = self.es_client.perform_search(index_name, body, Config.SEARCH_RESULTS_LIMIT)
-            results = [{
-                'Product ID': hit['_source'].get('id'),
-                'Product Name': hit['_source'].get('name'),
-                'Product URL': hit['_source'].get('productUrl', 'N/A'),
-                'Score': hit['_score']
-            } for hit in hits]
-            df = pd.DataFrame(results)
-            logger.info(f"    Semantic search returned {len(results)} results.")
-            return df
-        except Exception as e:
-            logger.error(f"    Error in Semantic search for '{term}': {e}")
-            return pd.DataFrame()
-
-    def run_hybrid_search(self, term: str, index_name: str) -> pd.DataFrame:
-        """Executes a hybrid search (multi_match + KNN) in Elasticsearch."""
-        logger.info(f"  Executing Hybrid search for '{term}' on index '{index_name}'...")
-
-        query_embedding = self._generate_query_embedding(term)
-
-        # Add lexical search (multi_match)
-
-        should_queries = [{
-            "multi_match": {
-                "query": term,
-                "fields": [
-                    "name^10.0",
-                    "description^5.0"
-                ],
-                "boost": 2.5
-            }
-        }]
+        # Each distinct term not memoized yet is embedded exactly once
+        terms_to_embed = [term for term in dict.fromkeys(terms) if term not in query_embeddings]
+        for i in range(0, len(terms_to_embed), Config.EMBEDDING_BATCH_SIZE):
+            batch_terms = terms_to_embed[i: i + Config.EMBEDDING_BATCH_SIZE]
+            batch_embeddings = self.genai_client.generate_embeddings(
+                texts=batch_terms,
+                model=Config.EMBEDDING_MODEL,
+                dimensions=Config.EMBEDDING_DIMENSIONS
+            )
+            if batch_embeddings is None or len(batch_embeddings) != len(batch_terms):
+                logger.warning(f"Could not precompute embeddings for terms {i + 1}-{i + len(batch_terms)}.")
+                continue
+            for term, embedding in zip(batch_terms, batch_embeddings):
+                query_embeddings[term] = embedding.tolist()
+        self._query_embedding_cache.update(query_embeddings)
+        logger.info(f"Precomputed embeddings for {len(query_embeddings)} of {len(set(terms))} search terms.")
+        return query_embeddings
+
+    def _build_lexical_query(self, term: str) -> Dict[str, Any]:
+        """Builds the weighted multi_match clause shared by lexical and hybrid search."""
+        return {"multi_match": {**self._multi_match_template, "query": term}}
+
+    def _build_semantic_body(self, query_embedding: List[float]) -> Dict[str, Any]:
+        """Builds the body of a pure vector (KNN) search."""
+        body = copy.copy(self._knn_body_template)
+        body["knn"] = {**self._knn_body_template["knn"], "query_vector": query_embedding}
+        return body
+
+    def _build_hybrid_body(self, term: str, query_embedding: List[float] | None) -> Dict[str, Any]:
+        """Builds the body of a hybrid search (multi_match + KNN, if an embedding is available)."""
+        should_queries = [self._build_lexical_query(term)]
 
         # Add vector search (KNN) if embedding was generated
         if query_embedding is not None:
-            should_queries.append({
-                "knn": {
-                    "field": Config.EMBEDDING_FIELD_NAME,
-                    "query_vector": query_embedding,
-                    "k": Config.SEARCH_RESULTS_LIMIT,
-                    "num_candidates": Config.SEARCH_RESULTS_LIMIT * 10,
-                    "boost": 2.0
-                }
-            })
+            should_queries.append({"knn": {**self._hybrid_knn_template, "query_vector": query_embedding}})
         else:
             logger.warning("    Query embedding not available for Hybrid search. Executing lexical search only.")
 
-        body = {
+        return {
             "query": {
                 "bool": {
                     "should": should_queries,
                     "minimum_should_match": 1  # At least one of the clauses must match
                 }
             },
-            "_source": ["name", "id", "productUrl"]
+            "fields": self._result_fields,
+            "_source": False
         }
 
-        try:
-            hits = self.es_client.perform_search(index_name, body, Config.SEARCH_RESULTS_LIMIT)
-            results = [{
-                'Product ID': hit['_source'].get('id'),
-                'Product Name': hit['_source'].get('name'),
-                'Product URL': hit['_source'].get('productUrl', 'N/A'),
-                'Score': hit['_score']
-            } for hit in hits]
-            df = pd.DataFrame(results)
-            logger.info(f"    Hybrid search returned {len(results)} results.")
-            return df
-        except Exception as e:
-            logger.error(f"    Error in Hybrid search for '{term}': {e}")
-            return pd.DataFrame()
-
-    def run_lexical_search(self, term: str, index_name: str) -> pd.DataFrame:
-        """Executes a lexical search (multi_match) in Elasticsearch."""
-        logger.info(f"  Executing Lexical search for '{term}' on index '{index_name}'...")
+    def _build_lexical_body(self, term: str) -> Dict[str, Any]:
+        """Builds the body of a lexical search (multi_match)."""
+        body = copy.copy(self._lex_body_template)
+        body["query"] = self._build_lexical_query(term)
+        return body
+
+    @staticmethod
+    def hit_field(hit: Dict[str, Any], field: str, default: Any = None) -> Any:
+        """Returns the first value of a field requested through the fields API, or the default."""
+        values = hit.get('fields', {}).get(field)
+        return values[0] if values else default
+
+    @classmethod
+    def append_hits(cls, columns: Dict[str, List[Any]], term: str, search_type: str, hits: List[Dict[str, Any]]):
+        """Appends hits to a dict-of-lists keyed by RESULT_COLUMNS, one row per hit."""
+        for rank, hit in enumerate(hits, start=1):
+            columns['term'].append(term)
+            columns['search_type'].append(search_type)
+            columns['rank'].append(rank)
+            columns['product_id'].append(cls.hit_field(hit, 'id'))
+            columns['product_name'].append(cls.hit_field(hit, 'name'))
+            columns['product_url'].append(cls.hit_field(hit, 'productUrl', 'N/A'))
+            columns['score'].append(hit['_score'])
+
+    def run_all_searches(
+            self,
+            term: str,
+            index_name: str,
+            embedding: List[float] | None = None
+    ) -> Dict[str, Tuple[List[Dict[str, Any]], float | None, str]]:
+        """
+        Executes the Semantic, Hybrid and Lexical searches for a term in a single _msearch request.
+        Returns, per search type, the raw hits, the server-side execution time in seconds
+        (from the 'took' field of each response) and a status: 'ok', 'skipped' (Semantic without
+        a query embedding) or 'error'. Searches that did not run have no execution time (None).
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"  Executing Semantic, Hybrid and Lexical searches for '{term}' on index '{index_name}'...")
+
+        query_embedding = embedding if embedding is not None else self._generate_query_embedding(term)
+
+        bodies: Dict[str, Dict[str, Any]] = {}
+        if query_embedding is not None:
+            bodies["Semantic"] = self._build_semantic_body(query_embedding)
+        bodies["Hybrid"] = self._build_hybrid_body(term, query_embedding)
+        bodies["Lexical"] = self._build_lexical_body(term)
 
-        body = {
-            "query": {
-                "multi_match": {
-                    "query": term,
-                    "fields": [
-                        "name^10.0",
-                        "description^5.0"
-                    ],
-                    "boost": 2.5
-                }
-            },
-            "_source": ["name", "id", "productUrl"]
+        results: Dict[str, Tuple[List[Dict[str, Any]], float | None, str]] = {
+            search_type: ([], None, SEARCH_STATUS_OK if search_type in bodies else SEARCH_STATUS_SKIPPED)
+            for search_type in ("Semantic", "Hybrid", "Lexical")
         }
-
         try:
-            hits = self.es_client.perform_search(index_name, body, Config.SEARCH_RESULTS_LIMIT)
-            results = [{
-                'Product ID': hit['_source'].get('id'),
-                'Product Name': hit['_source'].get('name'),
-                'Product URL': hit['_source'].get('productUrl', 'N/A'),
-                'Score': hit['_score']
-            } for hit in hits]
-            df = pd.DataFrame(results)
-            logger.info(f"    Lexical search returned {len(results)} results.")
-            return df
+            responses = self.es_client.msearch(
+                index_name,
+                list(bodies.values()),
+                [Config.SEARCH_RESULTS_LIMIT] * len(bodies)
+            )
         except Exception as e:
-            logger.error(f"    Error in Lexical search for '{term}': {e}")
-            return pd.DataFrame()
\ No newline at end of file
+            logger.error(f"    Error in multi-search for '{term}': {e}")
+            for search_type in bodies:
+                results[search_type] = ([], None, SEARCH_STATUS_ERROR)
+            return results
+
+        for search_type, response in zip(bodies.keys(), responses):
+            if 'error' in response:
+                logger.error(f"    Error in {search_type} search for '{term}': {response['error']}")
+                results[search_type] = ([], None, SEARCH_STATUS_ERROR)
+                continue
+            hits = response['hits']['hits']
+            results[search_type] = (hits, response.get('took', 0) / 1000, SEARCH_STATUS_OK)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"    {search_type} search returned {len(hits)} results.")
+        return results